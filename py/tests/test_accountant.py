@@ -1,5 +1,6 @@
+from concurrent.futures import Future
 from json import loads
-from typing import Optional
+from typing import List, Optional
 from unittest import mock
 
 import pytest
@@ -10,6 +11,7 @@ from arroyo.types import BrokerValue, Partition, Topic
 from arroyo.utils.clock import TestingClock
 
 from usageaccountant import UsageAccumulator, UsageUnit
+from usageaccountant.accumulator import KafkaConfig
 
 
 @pytest.fixture
@@ -127,3 +129,92 @@ def test_buffer_overflow(
     # the accumulator. It is not produced for buffer overflow.
     msg2 = broker.consume(Partition(topic, 0), 9500)
     assert msg2 is None
+
+
+@mock.patch("time.time")
+def test_record_many(
+    mock_time: mock.Mock, broker: LocalBroker[KafkaPayload]
+) -> None:
+    producer = broker.get_producer()
+    accumulator = UsageAccumulator(
+        60, topic_name="test_resource_usage", producer=producer
+    )
+
+    mock_time.return_value = 1594839910.1
+    accumulator.record_many(
+        [
+            ("metrics_consumer", "spans", 10, UsageUnit.BYTES),
+            ("metrics_consumer", "transactions", 10, UsageUnit.BYTES),
+            ("metrics_consumer", "spans", 5, UsageUnit.BYTES),
+        ]
+    )
+    accumulator.flush()
+
+    topic = Topic("test_resource_usage")
+    msg1 = broker.consume(Partition(topic, 0), 0)
+    assert_msg(
+        msg1, 1594839900, "metrics_consumer", "spans", 15, UsageUnit.BYTES
+    )
+    msg2 = broker.consume(Partition(topic, 0), 1)
+    assert_msg(
+        msg2,
+        1594839900,
+        "metrics_consumer",
+        "transactions",
+        10,
+        UsageUnit.BYTES,
+    )
+    assert broker.consume(Partition(topic, 0), 2) is None
+
+
+@mock.patch("arroyo.backends.kafka.consumer.KafkaProducer")
+def test_producer_config(mock_producer: mock.Mock) -> None:
+    UsageAccumulator(
+        kafka_config=KafkaConfig(
+            bootstrap_servers=["kafka.service.host:1234"],
+            config_params={"linger.ms": 10},
+        )
+    )
+
+    config = mock_producer.call_args[0][0]
+    assert config["bootstrap.servers"] == "kafka.service.host:1234"
+    assert config["linger.ms"] == 10
+    assert config["compression.type"] == "lz4"
+
+
+@mock.patch("time.time")
+def test_pending_deliveries(mock_time: mock.Mock) -> None:
+    futures: List[Future[BrokerValue[KafkaPayload]]] = []
+
+    def produce(
+        destination: Topic, payload: KafkaPayload
+    ) -> "Future[BrokerValue[KafkaPayload]]":
+        future: Future[BrokerValue[KafkaPayload]] = Future()
+        futures.append(future)
+        return future
+
+    producer = mock.Mock()
+    producer.produce.side_effect = produce
+    accumulator = UsageAccumulator(
+        60, topic_name="test_resource_usage", queue_size=2, producer=producer
+    )
+    mock_time.return_value = 1594839910.1
+
+    for feature in ("spans", "transactions"):
+        accumulator.record("metrics_consumer", feature, 10, UsageUnit.BYTES)
+    accumulator.flush()
+    assert producer.produce.call_count == 2
+
+    accumulator.record("metrics_consumer", "spans", 10, UsageUnit.BYTES)
+    with mock.patch("usageaccountant.accumulator.logger") as mock_logger:
+        # Two deliveries are pending so the message is dropped.
+        accumulator.flush()
+        assert producer.produce.call_count == 2
+        mock_logger.error.assert_called_once()
+
+        futures[0].set_exception(Exception("delivery failed"))
+        assert mock_logger.error.call_count == 2
+
+    accumulator.record("metrics_consumer", "spans", 10, UsageUnit.BYTES)
+    accumulator.flush()
+    assert producer.produce.call_count == 3
@@ -1,27 +1,50 @@
 import logging
 import time
-from collections import deque
 from concurrent.futures import Future
 from enum import Enum
-from json import dumps
 from math import floor
+from threading import Lock
 from typing import (
+    TYPE_CHECKING,
     Any,
-    Deque,
+    Iterable,
+    List,
     Mapping,
     MutableMapping,
     NamedTuple,
     Optional,
     Sequence,
+    Tuple,
 )
 
 from arroyo.backends.abstract import Producer
-from arroyo.backends.kafka.configuration import build_kafka_configuration
-from arroyo.backends.kafka.consumer import KafkaPayload, KafkaProducer
 from arroyo.types import BrokerValue, Topic
 
+if TYPE_CHECKING:
+    # The Kafka backend pulls in confluent_kafka, which dominates the
+    # import time of this module. It is only imported when it is used.
+    from arroyo.backends.kafka.consumer import KafkaPayload
 
-class UsageUnit(Enum):
+try:
+    import orjson
+
+    def _serialize(message: Mapping[str, Any]) -> bytes:
+        # Annotated so that the strict type check also passes when orjson
+        # is not installed and its import resolves to Any.
+        result: bytes = orjson.dumps(message)
+        return result
+
+except ImportError:  # pragma: no cover
+    import json
+
+    # Build the encoder once and match the compact output of orjson.
+    _encode = json.JSONEncoder(separators=(",", ":")).encode
+
+    def _serialize(message: Mapping[str, Any]) -> bytes:
+        return _encode(message).encode("utf-8")
+
+
+class UsageUnit(str, Enum):
     MILLISECONDS = "milliseconds"
     BYTES = "bytes"
     MILLISECONDS_SEC = "milliseconds_sec"
@@ -38,6 +61,14 @@ DEFAULT_TOPIC_NAME = "shared-resources-usage"
 DEFAULT_QUEUE_SIZE = 9500
 CLOSE_TIMEOUT_SEC = 60
 
+# flush() produces the whole batch in a tight loop. Give librdkafka some
+# time to coalesce those messages into few, compressed, requests. Any
+# option provided in `KafkaConfig.config_params` takes precedence.
+DEFAULT_PRODUCER_CONFIG: Mapping[str, Any] = {
+    "linger.ms": 100,
+    "compression.type": "lz4",
+}
+
 logger = logging.getLogger("usageaccountant")
 
 
@@ -75,7 +106,7 @@ class UsageAccumulator:
         topic_name: str = DEFAULT_TOPIC_NAME,
         queue_size: int = DEFAULT_QUEUE_SIZE,
         kafka_config: Optional[KafkaConfig] = None,
-        producer: Optional[Producer[KafkaPayload]] = None,
+        producer: Optional[Producer["KafkaPayload"]] = None,
     ) -> None:
         """
         Initializes the accumulator. Instances should be kept around
@@ -96,7 +127,7 @@ class UsageAccumulator:
                 "If producer is provided, initialization "
                 "parameters cannot be provided"
             )
-            self.__producer: Producer[KafkaPayload] = producer
+            self.__producer: Producer["KafkaPayload"] = producer
 
         else:
             assert kafka_config is not None, (
@@ -104,15 +135,26 @@ class UsageAccumulator:
                 "have to be provided"
             )
 
+            from arroyo.backends.kafka.configuration import (
+                build_kafka_configuration,
+            )
+            from arroyo.backends.kafka.consumer import KafkaProducer
+
             self.__producer = KafkaProducer(
                 build_kafka_configuration(
-                    default_config=kafka_config.config_params,
+                    default_config={
+                        **DEFAULT_PRODUCER_CONFIG,
+                        **kafka_config.config_params,
+                    },
                     bootstrap_servers=kafka_config.bootstrap_servers,
                 )
             )
 
         self.__queue_size = queue_size
-        self.__futures: Deque[Future[BrokerValue[KafkaPayload]]] = deque()
+        # Number of produced messages whose delivery has not been confirmed
+        # yet. Delivery callbacks run on the producer thread.
+        self.__in_flight = 0
+        self.__in_flight_lock = Lock()
 
         self.__last_log: Optional[float] = None
 
@@ -138,12 +180,7 @@ class UsageAccumulator:
         `usage_type` is the unit of measure for `amount`.
         """
         now = time.time()
-        if (
-            self.__first_timestamp is not None
-            and now - self.__first_timestamp >= self.__granularity_sec
-        ):
-            self.flush()
-            self.__first_timestamp = now
+        self.__flush_if_expired(now)
 
         key = UsageKey(
             floor(now / self.__granularity_sec) * self.__granularity_sec,
@@ -151,11 +188,50 @@ class UsageAccumulator:
             app_feature,
             usage_type,
         )
+        self.__add(key, amount, now)
+
+    def record_many(
+        self, records: Iterable[Tuple[str, str, int, UsageUnit]]
+    ) -> None:
+        """
+        Record several chunks of usage at once.
+
+        `records` is an iterable of `(resource_id, app_feature, amount,
+        usage_type)` tuples with the same meaning as the arguments of
+        `record`. This is equivalent to calling `record` for each of
+        them, but the system time is taken only once for the whole
+        batch, so all records land in the same time range.
+        """
+        now = time.time()
+        self.__flush_if_expired(now)
+
+        timestamp = (
+            floor(now / self.__granularity_sec) * self.__granularity_sec
+        )
+        for resource_id, app_feature, amount, usage_type in records:
+            self.__add(
+                UsageKey(timestamp, resource_id, app_feature, usage_type),
+                amount,
+                now,
+            )
 
+    def __flush_if_expired(self, now: float) -> None:
         if (
-            key not in self.__usage_batch
-            and len(self.__usage_batch) >= self.__queue_size
+            self.__first_timestamp is not None
+            and now - self.__first_timestamp >= self.__granularity_sec
         ):
+            self.flush()
+            self.__first_timestamp = now
+
+    def __add(self, key: UsageKey, amount: int, now: float) -> None:
+        # A single lookup tells both whether the key is new, which is the
+        # only case that can overflow the buffer, and what to add to.
+        current = self.__usage_batch.get(key)
+        if current is not None:
+            self.__usage_batch[key] = current + amount
+            return
+
+        if len(self.__usage_batch) >= self.__queue_size:
             # Avoid logging too often. Logging very often can become a major
             # overhead for the call site. This function can be called in tight
             # loops or in very high throughput scenarios. We should err on the
@@ -172,10 +248,7 @@ class UsageAccumulator:
         if self.__first_timestamp is None:
             self.__first_timestamp = now
 
-        if key not in self.__usage_batch:
-            self.__usage_batch[key] = amount
-        else:
-            self.__usage_batch[key] += amount
+        self.__usage_batch[key] = amount
 
     def flush(self) -> None:
         """
@@ -185,15 +258,18 @@ class UsageAccumulator:
         This method is supposed to be used when we are shutting
         down the program that was accumulating data.
         """
-        while self.__futures and self.__futures[0].done():
-            try:
-                self.__futures[0].result()
-            except Exception as e:
-                logger.exception(e)
-            self.__futures.popleft()
+        from arroyo.backends.kafka.consumer import KafkaPayload
+
+        # No message carries headers. Share one empty list across the
+        # payloads of this flush instead of allocating one per message.
+        headers: List[Tuple[str, bytes]] = []
+        # Resolve the loop invariants once rather than once per message.
+        produce = self.__producer.produce
+        topic = self.__topic
+        on_delivery = self.__on_delivery
 
         for key, amount in self.__usage_batch.items():
-            if len(self.__futures) >= self.__queue_size:
+            if self.__in_flight >= self.__queue_size:
                 logger.error(
                     (
                         "Too many Kafka messages pending callback. Clearing "
@@ -206,20 +282,29 @@ class UsageAccumulator:
                 "timestamp": key.timestamp,
                 "shared_resource_id": key.resource_id,
                 "app_feature": key.app_feature,
-                "usage_unit": key.unit.value,
+                "usage_unit": key.unit,
                 "amount": amount,
             }
 
-            result = self.__producer.produce(
-                self.__topic,
-                KafkaPayload(
-                    key=None, value=dumps(message).encode("utf-8"), headers=[]
-                ),
+            result = produce(
+                topic, KafkaPayload(None, _serialize(message), headers)
             )
-            self.__futures.append(result)
+            with self.__in_flight_lock:
+                self.__in_flight += 1
+            result.add_done_callback(on_delivery)
 
         self.__usage_batch.clear()
 
+    def __on_delivery(
+        self, future: "Future[BrokerValue[KafkaPayload]]"
+    ) -> None:
+        with self.__in_flight_lock:
+            self.__in_flight -= 1
+
+        error = future.exception()
+        if error is not None:
+            logger.error(error, exc_info=error)
+
     def close(self) -> None:
         result = self.__producer.close()
         try:
@@ -1,8 +1,19 @@
 import argparse
+import base64
+import gzip
+import hashlib
 import json
 import logging
 import os
+import random
+import re
+import ssl
+import threading
+import time
 import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPException, HTTPResponse, HTTPSConnection
 from typing import (
     Any,
     Dict,
@@ -16,7 +27,7 @@ from typing import (
     TypedDict,
     cast,
 )
-from urllib.request import Request, urlopen
+from urllib.error import HTTPError
 
 from usageaccountant.accumulator import (
     KafkaConfig,
@@ -24,15 +35,64 @@ from usageaccountant.accumulator import (
     UsageUnit,
 )
 
-headers = {
-    "DD-APPLICATION-KEY": os.environ.get("DATADOG_APP_KEY", ""),
-    "DD-API-KEY": os.environ.get("DATADOG_API_KEY", ""),
-}
+try:
+    import orjson
+
+    def _deserialize(data: bytes) -> Any:
+        return orjson.loads(data)
+
+except ImportError:  # pragma: no cover
+
+    def _deserialize(data: bytes) -> Any:
+        return json.loads(data)
+
+
+DATADOG_API_HOST = "api.datadoghq.com"
+DATADOG_QUERY_PATH = "/api/v1/query"
+# Queries are I/O bound, so they are sent to Datadog concurrently.
+MAX_CONCURRENT_QUERIES = 8
+# Throttled and failed requests are retried with exponential backoff.
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+MAX_QUERY_ATTEMPTS = 5
+RETRY_BACKOFF_SEC = 0.3
+# Upper limit on a Retry-After delay requested by Datadog.
+MAX_RETRY_DELAY_SEC = 30.0
+# Windows that ended less than this long ago are never cached.
+CACHE_SETTLE_SEC = 3600
+
+
+def build_headers(environ: Mapping[str, str]) -> Dict[str, str]:
+    """
+    Builds the Datadog request headers from the environment. Keys
+    missing from the environment are left out rather than sent empty.
+    """
+    return {
+        key: value
+        for key, value in {
+            "DD-APPLICATION-KEY": environ.get("DATADOG_APP_KEY", ""),
+            "DD-API-KEY": environ.get("DATADOG_API_KEY", ""),
+            # Timeseries responses are repetitive JSON and compress well.
+            "Accept-Encoding": "gzip",
+        }.items()
+        if value
+    }
+
+
+headers = build_headers(os.environ)
+
+# Matches one `key: value` pair of a series scope, e.g.
+# "app_feature: shared, shared_resource_id: rc_long_redis"
+SCOPE_PAIR_PATTERN = re.compile(r"\s*([^:,]*?)\s*:\s*([^:,]*?)\s*(?:,|\Z)")
+
+# Each thread keeps its HTTPS connection open across queries so that
+# only its first request pays for the TCP and TLS handshakes.
+_thread_local = threading.local()
+# Every connection opened by any thread, so that main() can close them
+# once the workers are done.
+_connections: List[HTTPSConnection] = []
+_connections_lock = threading.Lock()
 
 logger = logging.getLogger("fetcher")
-logging.basicConfig(
-    level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s"
-)
 
 
 class DatadogResponseUnit(TypedDict):
@@ -112,11 +172,12 @@ def assert_valid_query(query: str) -> None:
     assert "app_feature" in query
 
 
-def assert_valid_unit(unit: str) -> None:
+def assert_valid_unit(unit: str) -> UsageUnit:
     """
-    Validates if unit provided is supported by UsageUnit enum.
+    Validates if unit provided is supported by UsageUnit enum,
+    and returns the matching UsageUnit.
     """
-    UsageUnit(unit.lower())
+    return UsageUnit(unit.lower())
 
 
 def parse_and_assert_unit(series_list: Sequence[DatadogResponseSeries]) -> Any:
@@ -160,10 +221,93 @@ def warn_multiple_units(series_list: Sequence[DatadogResponseSeries]) -> None:
         logger.warning(f"Received multiple units from Datadog: {unit_list}.")
 
 
+def _new_connection() -> HTTPSConnection:
+    """
+    Opens a connection to the Datadog API. Like urlopen, it tunnels
+    through the proxy set in HTTPS_PROXY unless NO_PROXY excludes the
+    Datadog host.
+    """
+    context = ssl.create_default_context()
+    proxy = urllib.request.getproxies().get("https")
+    if not proxy or urllib.request.proxy_bypass(DATADOG_API_HOST):
+        return HTTPSConnection(DATADOG_API_HOST, context=context)
+
+    proxy_url = urllib.parse.urlsplit(
+        proxy if "://" in proxy else f"http://{proxy}"
+    )
+    assert proxy_url.hostname is not None, f"Invalid proxy: {proxy}"
+    connection = HTTPSConnection(
+        proxy_url.hostname, proxy_url.port or 80, context=context
+    )
+    tunnel_headers = {}
+    if proxy_url.username is not None:
+        credentials = ":".join(
+            urllib.parse.unquote(part)
+            for part in (proxy_url.username, proxy_url.password or "")
+        )
+        tunnel_headers["Proxy-Authorization"] = "Basic " + base64.b64encode(
+            credentials.encode("utf-8")
+        ).decode("ascii")
+    connection.set_tunnel(DATADOG_API_HOST, headers=tunnel_headers)
+    return connection
+
+
+def _send_request(path: str) -> HTTPResponse:
+    """
+    Sends a GET request for `path` to the Datadog API on the connection
+    of the current thread, opening it if needed.
+    """
+    connection: Optional[HTTPSConnection] = getattr(
+        _thread_local, "connection", None
+    )
+    if connection is None:
+        connection = _new_connection()
+        _thread_local.connection = connection
+        with _connections_lock:
+            _connections.append(connection)
+
+    try:
+        connection.request("GET", path, headers=headers)
+        return connection.getresponse()
+    except (HTTPException, ConnectionError):
+        # The server may have dropped the idle connection since the
+        # previous query. Reconnect and retry once.
+        connection.close()
+        connection.request("GET", path, headers=headers)
+        return connection.getresponse()
+
+
+def close_connections() -> None:
+    """
+    Closes the connections opened by _send_request on any thread.
+    """
+    with _connections_lock:
+        connections = list(_connections)
+        _connections.clear()
+    for connection in connections:
+        connection.close()
+
+
+def _retry_delay(response: HTTPResponse, attempt: int) -> float:
+    """
+    Returns how long to wait before retrying a throttled or failed
+    request. Honors Retry-After when Datadog sends it in seconds, up to
+    MAX_RETRY_DELAY_SEC, otherwise uses exponential backoff with full
+    jitter.
+    """
+    retry_after = response.getheader("Retry-After")
+    if retry_after is not None and retry_after.isdigit():
+        return min(float(retry_after), MAX_RETRY_DELAY_SEC)
+    return random.uniform(0, RETRY_BACKOFF_SEC * 2**attempt)
+
+
 def query_datadog(query: str, start_time: int, end_time: int) -> Any:
     """
     Fetches timeseries data from Datadog API, returns response dict.
 
+    Requests that are throttled or fail with a server error are
+    retried up to MAX_QUERY_ATTEMPTS times in total.
+
     query: Datadog query
     start_time: Start of the time window in Unix epoch format
                 with second-level precision
@@ -172,14 +316,80 @@ def query_datadog(query: str, start_time: int, end_time: int) -> Any:
     """
     data = {"query": query, "from": start_time, "to": end_time}
 
-    base_url = "https://api.datadoghq.com/api/v1/query"
     query_string = urllib.parse.urlencode(data)
-    full_url = f"{base_url}?{query_string}"
+    path = f"{DATADOG_QUERY_PATH}?{query_string}"
+
+    for attempt in range(MAX_QUERY_ATTEMPTS):
+        response = _send_request(path)
+        # Always drain the body so the connection can be reused.
+        body = response.read()
+        if (
+            response.status not in RETRY_STATUSES
+            or attempt == MAX_QUERY_ATTEMPTS - 1
+        ):
+            break
+        delay = _retry_delay(response, attempt)
+        logger.warning(
+            f"Datadog returned {response.status}, retrying in {delay:.1f}s."
+        )
+        time.sleep(delay)
+
+    if response.status != 200:
+        raise HTTPError(
+            f"https://{DATADOG_API_HOST}{path}",
+            response.status,
+            response.reason,
+            response.headers,
+            None,
+        )
+
+    if response.getheader("Content-Encoding") == "gzip":
+        body = gzip.decompress(body)
+
+    return _deserialize(body)
+
+
+def cached_query_datadog(
+    query: str, start_time: int, end_time: int, cache_dir: Optional[str]
+) -> Tuple[Any, Optional[str]]:
+    """
+    Same as query_datadog, but reads responses from cache_dir so that
+    reruns over the same window skip the network. Datadog may still be
+    ingesting data for a window shortly after it ends, so only windows
+    that ended more than CACHE_SETTLE_SEC ago are cached.
+
+    Returns the response and the path it should be cached at, which is
+    None when the response came from the cache or is not cacheable.
+    Callers write the response with write_cached_response only once it
+    has been validated, so that incomplete data is never cached.
+    """
+    if cache_dir is None or end_time > time.time() - CACHE_SETTLE_SEC:
+        return query_datadog(query, start_time, end_time), None
+
+    key = hashlib.blake2b(
+        f"{query}|{start_time}|{end_time}".encode("utf-8"), digest_size=16
+    ).hexdigest()
+    path = os.path.join(cache_dir, f"{key}.json.gz")
+    try:
+        with open(path, "rb") as f:
+            return _deserialize(gzip.decompress(f.read())), None
+    except FileNotFoundError:
+        pass
 
-    request = Request(url=full_url, headers=headers)
-    response = urlopen(request).read()
+    return query_datadog(query, start_time, end_time), path
 
-    return json.loads(response)
+
+def write_cached_response(path: str, response: Any) -> None:
+    """
+    Stores a validated response at a path from cached_query_datadog.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write to a temporary file first so that an interrupted run never
+    # leaves a truncated entry behind.
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(gzip.compress(json.dumps(response).encode("utf-8")))
+    os.replace(tmp_path, path)
 
 
 def parse_and_assert_response_series(
@@ -215,12 +425,10 @@ def parse_and_assert_response_scope(scope: str) -> Mapping[str, str]:
     Parses scope string of the response into a dict,
     and asserts presence of required key.
     """
-    param_dict = {}
-    parts = scope.split(",")
-    for part in parts:
-        sub_parts = part.split(":")
-        assert len(sub_parts) == 2
-        param_dict[sub_parts[0].strip()] = sub_parts[1].strip()
+    pairs = SCOPE_PAIR_PATTERN.findall(scope)
+    # Every comma separated part has to be exactly one `key: value` pair.
+    assert len(pairs) == scope.count(",") + 1 == scope.count(":")
+    param_dict = dict(pairs)
 
     assert "app_feature" in param_dict, (
         "Required parameters, app_feature not found "
@@ -290,21 +498,20 @@ def process_series_data(
     parsed_unit: UsageUnit parsed from API response
     shared_resource_id: From query config file
     """
-    record_list = []
+    record_list: List[UsageAccumulatorRecord] = []
     for series in series_list:
         app_feature = series["scope_dict"]["app_feature"]
-        for point in series["pointlist"]:
-            # skip records where there's no data recorded by Datadog
-            if point[1] is not None:
-                record_list.append(
-                    UsageAccumulatorRecord(
-                        resource_id=shared_resource_id,
-                        app_feature=app_feature,
-                        # point[0] is the timestamp
-                        amount=int(point[1]),
-                        usage_type=parsed_unit,
-                    )
+        record_list.extend(
+            [
+                UsageAccumulatorRecord(
+                    shared_resource_id, app_feature, int(amount), parsed_unit
                 )
+                # the first element of each point is the timestamp
+                for _, amount in series["pointlist"]
+                # skip records where there's no data recorded by Datadog
+                if amount is not None
+            ]
+        )
 
     return record_list
 
@@ -316,13 +523,7 @@ def post_to_usage_accumulator(
     """
     Posts UsageAccumulatorRecords to UsageAccumulator.
     """
-    for record in record_list:
-        usage_accumulator.record(
-            resource_id=record.resource_id,
-            app_feature=record.app_feature,
-            amount=record.amount,
-            usage_type=record.usage_type,
-        )
+    usage_accumulator.record_many(record_list)
 
 
 def log_records(record_list: Sequence[UsageAccumulatorRecord]) -> None:
@@ -342,8 +543,9 @@ def main(
     query_file: TextIO,
     start_time: int,
     period_seconds: int,
-    usage_accumulator: UsageAccumulator,
+    usage_accumulator: Optional[UsageAccumulator],
     dry_run: bool,
+    cache_dir: Optional[str] = None,
 ) -> None:
     """
     query_file: File with a list of dictionaries,
@@ -351,21 +553,57 @@ def main(
     start_time: Start of the time window in Unix epoch format
                 with second-level precision
     period_seconds: Duration of the time window in seconds
-    usage_accumulator: UsageAccumulator object
+    usage_accumulator: UsageAccumulator object, not needed for dry runs
+    cache_dir: Directory to cache Datadog responses in, disabled if None
     """
     query_list = parse_and_assert_query_file(query_file)
+    for query_dict in query_list:
+        assert_valid_query(query_dict["query"])
+
+    # Entries repeating a query only differ in how the response is
+    # attributed, so every distinct query is fetched once.
+    unique_queries = list(
+        dict.fromkeys(query_dict["query"].strip() for query_dict in query_list)
+    )
+    if len(unique_queries) < len(query_list):
+        logger.warning(
+            f"{len(query_list) - len(unique_queries)} duplicate queries "
+            "in the query file, fetching each query once."
+        )
+
+    end_time = start_time + period_seconds
+    try:
+        with ThreadPoolExecutor(
+            max_workers=MAX_CONCURRENT_QUERIES
+        ) as executor:
+            results = dict(
+                zip(
+                    unique_queries,
+                    executor.map(
+                        lambda query: cached_query_datadog(
+                            query, start_time, end_time, cache_dir
+                        ),
+                        unique_queries,
+                    ),
+                )
+            )
+    finally:
+        # The worker threads are gone, close their sockets cleanly
+        # instead of leaving them to the garbage collector.
+        close_connections()
+
     record_list: List[UsageAccumulatorRecord] = []
     for query_dict in query_list:
-        query = query_dict["query"]
+        query = query_dict["query"].strip()
+        response, cache_path = results[query]
         configured_unit = query_dict.get("unit")
         shared_resource_id = query_dict["shared_resource_id"]
 
-        assert_valid_query(query)
-
-        response = query_datadog(
-            query, start_time, (start_time + period_seconds)
-        )
         series_list = parse_and_assert_response_series(response)
+        if cache_path is not None:
+            write_cached_response(cache_path, response)
+            # Entries repeating the query share the response.
+            results[query] = (response, None)
 
         if configured_unit:
             # need not raise an error if a unit is configured
@@ -380,9 +618,8 @@ def main(
             parsed_unit = parse_and_assert_unit(series_list)
             unit = parsed_unit
 
-        assert_valid_unit(unit)
+        usage_unit = assert_valid_unit(unit)
         warn_multiple_units(series_list)
-        usage_unit = UsageUnit(unit.lower())
 
         record_list.extend(
             process_series_data(series_list, usage_unit, shared_resource_id)
@@ -391,12 +628,20 @@ def main(
     if dry_run:
         log_records(record_list)
     else:
+        assert usage_accumulator is not None
         post_to_usage_accumulator(record_list, usage_accumulator)
         usage_accumulator.flush()
         usage_accumulator.close()
 
 
 if __name__ == "__main__":
+    # Only configure logging when running as the fetcher CLI, so that
+    # importing this module does not install handlers on the root logger
+    # of the host process.
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s"
+    )
+
     parser = argparse.ArgumentParser(description="fetcher")
 
     parser.add_argument(
@@ -415,18 +660,26 @@ if __name__ == "__main__":
     parser.add_argument(
         "--kafka_config_file",
         type=argparse.FileType("r"),
-        help="File containing kafka_config for initializing UsageAccumulator",
+        help="File containing kafka_config for initializing UsageAccumulator; "
+        "not needed with --dry_run",
     )
     parser.add_argument(
         "--dry_run",
         action="store_true",
         help="Log data instead of sending it to Kafka",
     )
+    parser.add_argument(
+        "--cache_dir",
+        help="Directory to cache Datadog responses in, "
+        "so that reruns over past windows skip the network",
+        required=False,
+    )
     args = parser.parse_args()
 
-    if args.start_time is None:
-        import time
+    if "DD-APPLICATION-KEY" not in headers or "DD-API-KEY" not in headers:
+        parser.error("DATADOG_APP_KEY and DATADOG_API_KEY must be set")
 
+    if args.start_time is None:
         current_time = int(time.time())
         args.start_time = (
             current_time
@@ -434,12 +687,17 @@ if __name__ == "__main__":
             - args.period_seconds
         )
 
-    kafka_config = parse_and_assert_kafka_config(args.kafka_config_file)
+    # A dry run never produces to Kafka, so do not start a producer.
+    usage_accumulator = None
+    if not args.dry_run:
+        kafka_config = parse_and_assert_kafka_config(args.kafka_config_file)
+        usage_accumulator = UsageAccumulator(kafka_config=kafka_config)
 
     main(
         args.query_file,
         args.start_time,
         args.period_seconds,
-        UsageAccumulator(kafka_config=kafka_config),
+        usage_accumulator,
         args.dry_run,
+        args.cache_dir,
     )